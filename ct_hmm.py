@@ -1,21 +1,111 @@
 import numpy as np
-from scipy.stats import norm
-from scipy.stats import multivariate_normal
 from scipy.linalg import expm
-from scipy.special import logsumexp
-from scipy.interpolate import interp1d
-from scipy.integrate import solve_ivp
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import expm_multiply
 import itertools
 import bisect
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from numba import njit, prange, get_num_threads, set_num_threads
+    HAS_NUMBA = True
+except ImportError:
+    # numba is optional, without it the recursions below run as plain python
+    HAS_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda f: f
+    prange = range
+
+@njit(cache=True, fastmath=True, nogil=True)
+def forward_recursion(pi0, expm_Q_t_stack, log_b_stack):
+    '''
+    @summary: scaled forward recursion for one patient
+    @param pi0: start state probabilities
+    @param expm_Q_t_stack: (T-1,n,n) array, expm(Q*t) for each interval between observations
+    @param log_b_stack: (T,n) array, log emissions for each observation
+    @return: Alpha (T,n) and log scaling factors C (T,)
+    @description: emissions are shifted by their max in log space before leaving it, so far-tailed observations do not underflow
+    '''
+    T, num_state = log_b_stack.shape
+    Alpha = np.zeros((T, num_state))
+    C = np.zeros(T)
+    log_b_max = np.max(log_b_stack[0])
+    alpha = pi0*np.exp(log_b_stack[0]-log_b_max)
+    c = np.sum(alpha)
+    C[0] = np.log(c) + log_b_max
+    Alpha[0] = alpha/c
+    for i in range(1, T):
+        log_b_max = np.max(log_b_stack[i])
+        alpha = np.exp(log_b_stack[i]-log_b_max)*np.dot(Alpha[i-1], expm_Q_t_stack[i-1])
+        c = np.sum(alpha)
+        C[i] = np.log(c) + log_b_max
+        Alpha[i] = alpha/c
+    return Alpha, C
+
+@njit(cache=True, fastmath=True, nogil=True)
+def backward_recursion(expm_Q_t_stack, log_b_stack, C):
+    '''
+    @summary: scaled backward recursion for one patient, uses the log scaling factors of forward_recursion
+    @return: Beta (T,n)
+    '''
+    T, num_state = log_b_stack.shape
+    Beta = np.ones((T, num_state))
+    for i in range(T-2, -1, -1):
+        Beta[i] = np.dot(expm_Q_t_stack[i], Beta[i+1]*np.exp(log_b_stack[i+1]-C[i+1]))
+    return Beta
+
+@njit(cache=True, nogil=True)
+def dominance_pair(a, b):
+    '''
+    @summary: fail fast dominance test between two probability curves
+    @return: 1 if a > b everywhere, -1 if a < b everywhere, 0 otherwise
+    @description: returns as soon as one coordinate rules out each direction, most pairs stop well before the end of the curve
+    '''
+    not_gt = False
+    not_lt = False
+    for k in range(a.shape[0]):
+        if a[k] <= b[k]:
+            not_gt = True
+        if a[k] >= b[k]:
+            not_lt = True
+        if not_gt and not_lt:
+            return 0
+    if not not_gt:
+        return 1
+    if not not_lt:
+        return -1
+    return 0
+
+@njit(cache=True, nogil=True, parallel=True)
+def dominance_rows(Stack, NewPs, Owner):
+    '''
+    @summary: dominance_pair for many pairs in parallel, row r of Stack against NewPs[Owner[r]]
+    @return: (len(Stack),) array of dominance_pair results
+    '''
+    Dom = np.zeros(Stack.shape[0], dtype=np.int64)
+    for r in prange(Stack.shape[0]):
+        Dom[r] = dominance_pair(Stack[r], NewPs[Owner[r]])
+    return Dom
+
+def effective_n_jobs(n_jobs):
+    '''
+    @param n_jobs: number of threads asked for, as in joblib n_jobs <= 0 means one per cpu
+    @return: number of threads to use, at least 1
+    '''
+    if n_jobs <= 0:
+        return os.cpu_count() or 1
+    return n_jobs
 
 class CT_HMM_LEARNER:
-    def __init__(self,Q,pi0,ls_mu,ls_sigma,patients = [], structure = "fc", method="eigen", bound = True):
+    def __init__(self,Q,pi0,ls_mu,ls_sigma,patients = [], structure = "fc", method="eigen", bound = True, dtype=np.float64):
         '''
         @param Q: rate matrix
         @param pi0: start state probabilities
         @param ls_mu: list of means
         @param ls_sigma: variances
         @param patients: list of Patient objects
+        @param dtype: precision of the eigen method E-step contractions, np.float32 halves the memory traffic
         '''
         self.pi0 = pi0
         self.ls_mu = ls_mu
@@ -26,8 +116,12 @@ class CT_HMM_LEARNER:
             for i in range(1,len(ls_mu)):
                 self.num_state *= len(ls_mu[i])
         self.ls_sigma = ls_sigma
+        self.set_emission_params()
         
+        self.structure = structure
         self.Q_struct = self.create_Q_struct(struct=structure, numstates=self.num_state)
+        #(i,j) index pairs of the allowed transitions
+        self.Q_idx = np.argwhere(self.Q_struct == 1)
         print(self.Q_struct)
         if Q is None:
             np.random.seed(65)
@@ -44,6 +138,7 @@ class CT_HMM_LEARNER:
         self.patients = patients
         self.method = method
         self.bound = bound
+        self.dtype = dtype
         
     def get_time_intervals(self):
         '''
@@ -58,77 +153,63 @@ class CT_HMM_LEARNER:
         self.time_intervals = np.unique(np.array(sorted(time_intervals)))
         
     def create_Q_struct(self, struct, numstates):
-        Q_struct = np.zeros((numstates,numstates))
         if struct == "fc":
-            for i in range(numstates):
-                for j in range(numstates):
-                    if i != j:
-                        Q_struct[i,j] = 1
-            
-        elif struct == "forward_step":
-            temp = []
-            for i in range(len(self.ls_mu)):
-                temp_2 = []
-                for j in range(len(self.ls_mu[i])):
-                    temp_2.append(j)
-                temp.append(temp_2)
-
-            for i, state_combos_i in enumerate(itertools.product(*temp)): #represents going down the rows in q matrix, the original state
-                for j, state_combos_j in enumerate(itertools.product(*temp)):# this represents the state we are transitioning into
-                    if state_combos_i != state_combos_j:
-                        within_step = True
-                        for idx in range(len(state_combos_j)):
-                            if (state_combos_j[idx] - state_combos_i[idx] < 0) or (state_combos_j[idx] - state_combos_i[idx]) > 1:
-                                # if it is not forward or if the difference between the two states is greater than a step of 1
-                                within_step = False
-                        if within_step:
-                            Q_struct[i,j] = 1
-                                                
-        elif struct == "forward_any":
-            temp = []
-            for i in range(len(self.ls_mu)):
-                temp_2 = []
-                for j in range(len(self.ls_mu[i])):
-                    temp_2.append(j)
-                temp.append(temp_2)
+            Q_struct = np.ones((numstates,numstates)) - np.eye(numstates)
             
-            for i, state_combos_i in enumerate(itertools.product(*temp)): #represents going down the rows in q matrix, the original state
-                for j, state_combos_j in enumerate(itertools.product(*temp)):# this represents the state we are transitioning into
-                    if state_combos_i != state_combos_j:
-                        forward = True
-                        for idx in range(len(state_combos_j)):
-                            if state_combos_j[idx] - state_combos_i[idx] < 0: # if it is not forward, then skip
-                                forward = False
-                                continue
-                        if forward:
-                            Q_struct[i,j] = 1
+        elif struct in ("forward_step", "forward_any"):
+            #index of each observation dimension for every state, rows ordered as in itertools.product
+            states = np.array(list(itertools.product(*[range(len(mu)) for mu in self.ls_mu])))
+            #diff[i,j] is the step from the original state i to the state j we are transitioning into
+            diff = states[None,:,:] - states[:,None,:]
+            if struct == "forward_step":
+                # forward and at most a step of 1 in every dimension
+                mask = np.all((diff >= 0) & (diff <= 1), axis=-1) & np.any(diff != 0, axis=-1)
+            else:
+                # forward in every dimension
+                mask = np.all(diff >= 0, axis=-1) & np.any(diff > 0, axis=-1)
+            Q_struct = mask.astype(float)
         else:
             raise Exception('Unknown method, must be fc, forward_step, or forward_any') # Don't! If you catch, likely to hide bugs.
         
         return Q_struct
     
-    def matrix_exponentials(self):
+    def matrix_exponentials(self, max_cond=1e8):
         '''
         @summary: iterate over time intervals and calculate relevant matrix exponentials expm(Q*t) for current Q
+        @param max_cond: largest condition number of the eigenvectors for which the eigendecomposition is reused
+        @description: evaluates expm(Q*t) = U diag(exp(D*t)) V for all time intervals at once, redoing the
+        eigendecomposition first if it is missing or was done for another Q. Falls back to a batched expm if U is ill-conditioned.
         '''
+        if not self.eigendecomposition_valid():
+            self.set_eigendecomposition()
         expm_Q_t = {}
-        for t in self.time_intervals:
-            expm_Q_t[t] = expm(self.Q*t)
+        if np.linalg.cond(self.U) < max_cond:
+            E = np.exp(np.outer(self.time_intervals, np.diag(self.D)))
+            expm_Q_t_stack = np.matmul(self.U * E[:, None, :], self.V)
+            if np.iscomplexobj(expm_Q_t_stack):
+                expm_Q_t_stack = expm_Q_t_stack.real
+            for t, expm_matrix in zip(self.time_intervals, expm_Q_t_stack):
+                expm_Q_t[t] = expm_matrix
+        else:
+            expm_Q_t_stack = expm(self.Q*self.time_intervals[:, None, None])
+            for t, expm_matrix in zip(self.time_intervals, expm_Q_t_stack):
+                expm_Q_t[t] = expm_matrix
         self.expm_Q_t = expm_Q_t
     
-    def run_EM(self,fast_eigen=False,tol=1e-4,verbose=True,update_sigma=0, update_mu = True):
+    def run_EM(self,fast_eigen=False,tol=1e-4,verbose=True,update_sigma=0, update_mu = True, n_jobs=1):
         '''
-        @param fast_eigen: True if use fast_eigen, False if use grouping instead
+        @param fast_eigen: kept for compatibility, Psi_eigen is always grouped by unique time interval now
         @param tol: the absolute difference between old and new log-likelihood needed to terminate
         @param verbose: if True print the log-likelihood at each iteration
         @param update_sigma: if 1 learn variances of observation model
         @param update_mu: if True learn means of observation model
+        @param n_jobs: number of threads the patients are split over in the E-step, 1 runs them sequentially, <= 0 uses one per cpu
         @description: run EM algorithm until convergence
         '''
         old_log_likelihood = -np.inf
         new_log_likelihood = 0
         while np.abs(old_log_likelihood-new_log_likelihood)>tol:
-            self.EM_step(update_sigma=update_sigma, update_mu=update_mu, fast_eigen=fast_eigen)
+            self.EM_step(update_sigma=update_sigma, update_mu=update_mu, fast_eigen=fast_eigen, n_jobs=n_jobs)
             old_log_likelihood = new_log_likelihood
             new_log_likelihood = self.calculate_log_likelihood()
             if verbose:
@@ -138,12 +219,12 @@ class CT_HMM_LEARNER:
     def calculate_log_likelihood(self):
         log_likelihood = 0
         for patient in self.patients:
-            log_likelihood += np.sum(np.log(patient.C))
+            log_likelihood += np.sum(patient.C)
         return log_likelihood
     
     def calculate_log_likelihood_patient(self, patient):
         log_likelihood = 0
-        log_likelihood += np.sum(np.log(patient.C))
+        log_likelihood += np.sum(patient.C)
         return log_likelihood
     
     def set_eigendecomposition(self):
@@ -152,12 +233,67 @@ class CT_HMM_LEARNER:
         @set self.U: right eigenvectors
         @set self.V: inverse of right eigenvectors
         @set self.D: eigenvalues
+        @set self.U_work, self.V_work: U and V in self.work_dtype, the precision of the E-step contractions
+        @set self.eigen_Q: copy of the Q that was decomposed
         '''
+        self.eigen_Q = np.copy(self.Q)
         D, self.U = np.linalg.eig(self.Q)
         self.D = np.diag(D)
         self.V = np.linalg.inv(self.U)
+        #complex if the eigendecomposition is
+        self.work_dtype = np.promote_types(self.dtype, np.complex64) if np.iscomplexobj(self.U) else np.dtype(self.dtype)
+        self.U_work = self.U.astype(self.work_dtype, copy=False)
+        self.V_work = self.V.astype(self.work_dtype, copy=False)
     
-    def EM_step(self, update_sigma=0, update_mu=True, fast_eigen = True):
+    def eigendecomposition_valid(self):
+        '''
+        @return: True if set_eigendecomposition has been called for current Q
+        '''
+        return hasattr(self, "eigen_Q") and self.eigen_Q.shape == self.Q.shape and np.array_equal(self.eigen_Q, self.Q)
+    
+    def use_expm_multiply(self, min_states=128, max_density=0.1):
+        '''
+        @param min_states: fewest states for which expm_multiply is used
+        @param max_density: largest fraction of nonzero entries of Q for which expm_multiply is used
+        @return: True if applying expm(Q*t) to a vector with expm_multiply beats forming expm(Q*t),
+        below a few hundred states the dense expm is faster unless Q is very sparse
+        '''
+        return self.num_state >= min_states and np.count_nonzero(self.Q) <= max_density*self.num_state**2
+    
+    def set_emission_params(self):
+        '''
+        @summary: precompute the per-state constants of the (diagonal) Gaussian observation model for current ls_mu, ls_sigma,
+        called at the start of every EM_step, call again if ls_mu or ls_sigma are changed otherwise
+        @set self.emission_mu: (n,d) means, one row per state in itertools.product order
+        @set self.emission_inv_2s2: (n,d) 1/(2*sigma^2)
+        @set self.emission_log_norm_const: (n,) log of the normalizing constants
+        '''
+        self.emission_mu = np.array(list(itertools.product(*self.ls_mu)), dtype=float)
+        sigma = np.array(list(itertools.product(*self.ls_sigma)), dtype=float)
+        self.emission_inv_2s2 = 0.5/sigma**2
+        self.emission_log_norm_const = -np.sum(np.log(sigma*np.sqrt(2*np.pi)), axis=1)
+    
+    def gaussian_log_emissions(self, observations):
+        '''
+        @param observations: list of T observations, scalars or tuples with one value per dimension
+        @return: (T,n) array of log likelihoods, one row per observation and one column per state
+        '''
+        obs = np.asarray(observations, dtype=float).reshape(len(observations), -1)
+        diff = obs[:,None,:] - self.emission_mu[None,:,:]
+        return self.emission_log_norm_const - np.sum(diff*diff*self.emission_inv_2s2, axis=2)
+    
+    def gaussian_emissions(self, observations):
+        '''
+        @param observations: list of T observations, scalars or tuples with one value per dimension
+        @return: (T,n) array of likelihoods, one row per observation and one column per state
+        '''
+        return np.exp(self.gaussian_log_emissions(observations))
+    
+    def EM_step(self, update_sigma=0, update_mu=True, fast_eigen = True, n_jobs=1):
+        '''
+        @param n_jobs: number of threads the patients are split over in the E-step, 1 runs them sequentially, <= 0 uses one per cpu
+        '''
+        n_jobs = effective_n_jobs(n_jobs)
         num_state = self.num_state
         Nij = 0
         TauI = 0
@@ -168,62 +304,81 @@ class CT_HMM_LEARNER:
         sigma_denominator = np.zeros(num_state)
         pi0_numerator = np.zeros(num_state)
         pi0_denominator = np.zeros(num_state)
-        #pre-comput matrix exponentials and eigendecomposition
-        self.matrix_exponentials()
-        self.set_eigendecomposition()
-        if fast_eigen==False and self.method =="eigen":
-            #pre-comput all end-state conditioned expectations
-            self.Eigen_all_end_state_conditioned()
-        for patient in self.patients:
-            #get emissions for patient
-            patient.get_all_emissions_gaussian(self)
-            if self.method == "eigen":
-                Nij += self.Eigen_Nij_all_times(patient,fast_eigen=fast_eigen)
-                TauI += self.Eigen_TauI_all_times(patient)
-            elif self.method == "expm":
-                temptau, tempn = self.Expm_TauI_Nij_all_times(patient)
-                Nij += tempn
-                TauI += temptau
-            
-            #get Alpha forward recursion
-            patient.alpha_forward_recursion(self)
-            Alpha = patient.Alpha
-            C = patient.C
-            #get Beta backward recursion
-            patient.beta_backward_recursion(self)
-            Beta = patient.Beta
-            #iterate over observations
-            for t in range(patient.num_obs):
-                #get the marginal beliefs
-                gamma_t = Alpha[t,:]*Beta[t,:]
-                if t==0:
-                    pi0_numerator+=gamma_t
-                    pi0_denominator+=np.sum(gamma_t)
-#                 mu_numerator += gamma_t*patient.O[t]
-#                 mu_denominator += gamma_t
-#                 sigma_numerator += gamma_t*((np.repeat(patient.O[t],num_state)-self.ls_mu)**2)
-#                 sigma_denominator += gamma_t
+        #pre-comput observation model constants, eigendecomposition and matrix exponentials
+        self.set_emission_params()
+        if not self.cached_matrices_valid():
+            self.set_eigendecomposition()
+            self.matrix_exponentials()
+            if self.method =="eigen":
+                #pre-comput Psi_eigen once per unique time interval, Q is fixed during the E-step
+                self.Psi_eigen = {t: self.calculate_Psi_eigen(t).astype(self.work_dtype, copy=False) for t in self.time_intervals}
+            self.cached_matrices_key = (np.copy(self.Q), np.copy(self.time_intervals), self.method, self.dtype)
+        #patients are independent given the current parameters
+        if n_jobs == 1:
+            contributions = [self.patient_contribution(patient, fast_eigen=fast_eigen) for patient in self.patients]
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                contributions = list(executor.map(lambda patient: self.patient_contribution(patient, fast_eigen=fast_eigen), self.patients))
+        for patient_Nij, patient_TauI, gamma_0 in contributions:
+            Nij += patient_Nij
+            TauI += patient_TauI
+            pi0_numerator+=gamma_0
+            pi0_denominator+=np.sum(gamma_0)
         self.update_model_params(Nij,TauI,mu_numerator,mu_denominator,pi0_numerator,pi0_denominator,sigma_numerator,sigma_denominator,update_sigma=update_sigma, update_mu=update_mu)
     
+    def cached_matrices_valid(self, rtol=1e-12):
+        '''
+        @param rtol: relative tolerance within which Q counts as unchanged
+        @return: True if the eigendecomposition, expm_Q_t and Psi_eigen from the last EM_step still hold for current Q and time intervals
+        '''
+        if not hasattr(self, "cached_matrices_key"):
+            return False
+        Q, time_intervals, method, dtype = self.cached_matrices_key
+        return (method == self.method and dtype == self.dtype
+                and np.array_equal(time_intervals, self.time_intervals)
+                and Q.shape == self.Q.shape and np.allclose(Q, self.Q, rtol=rtol, atol=0))
+    
+    def patient_contribution(self, patient, fast_eigen=True):
+        '''
+        @param patient: a Patient object
+        @description: E-step for a single patient, only reads the learner and sets the patient's emissions and recursions
+        @return: expected transition counts Nij, expected state durations TauI and marginal beliefs at the first observation
+        '''
+        #get emissions for patient
+        patient.get_all_emissions_gaussian(self)
+        #get Alpha forward recursion
+        patient.alpha_forward_recursion(self)
+        Alpha = patient.Alpha
+        #get Beta backward recursion
+        patient.beta_backward_recursion(self)
+        Beta = patient.Beta
+        if self.method == "eigen":
+            Nij = self.Eigen_Nij_all_times(patient,fast_eigen=fast_eigen)
+            TauI = self.Eigen_TauI_all_times(patient,fast_eigen=fast_eigen)
+        elif self.method == "expm":
+            TauI, Nij = self.Expm_TauI_Nij_all_times(patient)
+        
+        #get the marginal beliefs at the first observation
+        gamma_0 = Alpha[0,:]*Beta[0,:]
+        return Nij, TauI, gamma_0
+    
     def update_model_params(self,Nij,TauI,mu_numerator,mu_denominator,pi0_numerator,pi0_denominator,sigma_numerator,sigma_denominator,update_sigma=False, update_mu=True):
         #update Q matrix off-diagonal elements
-        for i in range(self.num_state):
-            for j in range(self.num_state):
-                if self.Q_struct[i,j] == 1:
-                    self.Q[i,j] = Nij[i,j]/TauI[i]
-                    if np.isnan(self.Q[i,j]):
-                        import pdb; pdb.set_trace()
-                    if self.bound:
-                        if self.Q[i,j] < 1e-10: # added bounding to prevent floating point errors that lead expm(Q) to introduce negative values
-                            self.Q[i,j] = 1e-10
+        I, J = self.Q_idx[:,0], self.Q_idx[:,1]
+        Q_vals = Nij[I,J]/TauI[I]
+        if np.isnan(Q_vals).any():
+            import pdb; pdb.set_trace()
+        if self.bound:
+            Q_vals = np.maximum(Q_vals, 1e-10) # added bounding to prevent floating point errors that lead expm(Q) to introduce negative values
+        self.Q[I,J] = Q_vals
 
+        #update model parameters
+        np.fill_diagonal(self.Q, 0)
+        np.fill_diagonal(self.Q, -np.sum(self.Q,1))
         #storage lists
         ls_mu = []
         ls_sigma = []
-        #update model parameters
         for i in range(self.num_state):
-            self.Q[i,i] = 0
-            self.Q[i,i] = -np.sum(self.Q[i,:])
             if update_mu:
                 ls_mu.append(mu_numerator[i]/mu_denominator[i])
             if update_sigma:
@@ -234,81 +389,50 @@ class CT_HMM_LEARNER:
         if update_sigma:
             self.ls_sigma = ls_sigma
         
-    def Eigen_all_end_state_conditioned(self):
-        self.TauI_end_state = {}
-        self.Nij_end_state = {}
-        for t in self.time_intervals:
-            Psi_eigen = self.calculate_Psi_eigen(t)
-            for i in range(self.num_state):
-                self.Eigen_TauI_time_interval_end_state(t,Psi_eigen,i)
-                for j in range(self.num_state):
-                    self.Eigen_Nij_time_interval_end_state(t,Psi_eigen,i,j)
-    
-    def Eigen_Nij_time_interval_end_state(self,t,Psi_eigen,i,j):
-        Aij = np.multiply(np.outer(self.V[:,i],self.U[j,:]), Psi_eigen)
-        if i!=j:
-            self.Nij_end_state[(t,i,j)]=self.Q[i,j]*np.dot(np.dot(self.U,Aij),self.V)
-        else:
-            self.Nij_end_state[(t,i,j)]=0
-    
     def Eigen_Nij_time_interval(self,Zeta_matrix, t, Psi_eigen):
         '''
         @param t: time interval between observations
         @param Zeta_matrix: this has the pairwise beliefs
         @param Psi_eigen: a matrix needed for Eigen method
         '''
-        #Get Q matrix and number of states
-        num_state = self.num_state
+        F = (Zeta_matrix/self.expm_Q_t[t]).astype(self.work_dtype, copy=False)
+        B = np.dot(np.dot(np.transpose(self.U_work), F), np.transpose(self.V_work))
+        #sum(outer(V[:,i],U[j,:])*Psi_eigen*B) for all i,j at once
+        M = np.real(np.dot(np.dot(np.transpose(self.V_work), np.multiply(Psi_eigen,B)), np.transpose(self.U_work))).astype(np.float64)
         #set up transition count matrix for specific time interval
-        Nij_mat = np.zeros((num_state,num_state))
-        F = Zeta_matrix/self.expm_Q_t[t]
-        B = np.dot(np.dot(np.transpose(self.U), F), np.transpose(self.V))
-        for i in range(num_state):
-            for j in range(num_state):
-                Aij = np.multiply(np.outer(self.V[:,i],self.U[j,:]), Psi_eigen)
-                temp = np.multiply(Aij,B)
-                if i!=j:
-                    Nij_mat[i,j]=self.Q[i,j]*np.sum(temp)
+        Nij_mat = self.Q*M
+        np.fill_diagonal(Nij_mat, 0)
         return Nij_mat
     
-    def Eigen_TauI_time_interval_end_state(self,t,Psi_eigen,i):
-        Ai = np.multiply(np.outer(self.V[:,i],self.U[i,:]), Psi_eigen)
-        if i!=j:
-            self.TauI_end_state[(t,i)]=self.Q[i,j]*np.dot(np.dot(self.U,Ai),self.V)
-
     def Eigen_TauI_time_interval(self,Zeta_matrix, t, Psi_eigen):
-        #Get Q matrix and number of states
-        num_state = np.shape(self.Q)[0]
-        TauI = np.zeros(num_state)
-        F = Zeta_matrix/self.expm_Q_t[t]
-        B = np.dot(np.dot(np.transpose(self.U), F), np.transpose(self.V))
-        for i in range(num_state):
-            Ai = np.multiply(np.outer(self.V[:,i],self.U[i,:]), Psi_eigen)
-            temp = np.multiply(Ai,B)
-            TauI[i] = np.sum(temp)
-            
+        F = (Zeta_matrix/self.expm_Q_t[t]).astype(self.work_dtype, copy=False)
+        B = np.dot(np.dot(np.transpose(self.U_work), F), np.transpose(self.V_work))
+        #sum(outer(V[:,i],U[i,:])*Psi_eigen*B) is the diagonal of the same product as in Eigen_Nij_time_interval
+        M = np.dot(np.dot(np.transpose(self.V_work), np.multiply(Psi_eigen,B)), np.transpose(self.U_work))
+        TauI = np.real(np.diag(M)).astype(np.float64)
         return TauI
 
     def calculate_Psi_eigen(self,t):
-        num_state = np.shape(self.Q)[0]
-        D, U = np.linalg.eig(self.Q)
-        Psi_eigen = np.zeros((num_state,num_state))
-        for p in range(num_state):
-            for q in range(num_state):
-                if D[p]==D[q]:
-                    Psi_eigen[p,q] = t*np.exp(t*D[p])
-                else:
-                    Psi_eigen[p,q] = (np.exp(t*D[p])-np.exp(t*D[q]))/(D[p]-D[q])
+        '''
+        @param t: time interval
+        @description: uses the eigenvalues from set_eigendecomposition, Psi[p,q] = (exp(t*D[p])-exp(t*D[q]))/(D[p]-D[q]), or t*exp(t*D[p]) if D[p]==D[q]
+        '''
+        D = np.diag(self.D)
+        exps = np.exp(t*D)
+        numer = exps[:,None] - exps[None,:]
+        denom = D[:,None] - D[None,:]
+        equal = np.abs(denom) < 1e-14
+        Psi_eigen = np.where(equal, t*exps[:,None], numer/np.where(equal, 1, denom))
         return Psi_eigen
         
     def Expm_TauI_Nij_all_times(self, patient):
+        '''
+        @param patient: a Patient object, its emissions, Alpha and Beta have to be computed for the current parameters
+        '''
         T = patient.num_obs
         num_state = self.num_state
-        patient.alpha_forward_recursion(self)
         Alpha = patient.Alpha
-        patient.beta_backward_recursion(self)
         Beta = patient.Beta
-        patient.get_all_emissions_gaussian(self)
         
         TauI = np.zeros(num_state)
         Nij_mat = np.zeros((num_state,num_state))
@@ -317,106 +441,73 @@ class CT_HMM_LEARNER:
         A[0:num_state, 0:num_state] = self.Q
         A[(num_state):num_state*2+1, (num_state):num_state*2+1] = self.Q
         
+        #unique time intervals of this patient, so expm(A*t) is evaluated once per t in a single batched call
+        time_diffs = np.diff(patient.observation_times)
+        unique_times, time_index = np.unique(time_diffs, return_inverse=True)
+        unique_times = unique_times[:, None, None]
+        #Zeta/P_t does not depend on (i,j), compute it once per time interval, zero where P_t is zero
+        F_stack = np.zeros((T-1, num_state, num_state))
+        for t_index in range(1,T):
+            t = time_diffs[t_index-1]
+            Pt_kl = self.expm_Q_t[t]
+            Zeta_matrix = self.get_zeta(t,patient,Alpha[t_index-1],Beta[t_index],t_index)
+            nonzero = Pt_kl != 0
+            F_stack[t_index-1] = np.where(nonzero, Zeta_matrix/np.where(nonzero, Pt_kl, 1.0), 0.0)
+        
         for i in range(num_state):
             A[i, i + num_state] = 1
-            for t_index in range(1,T):
-                t = patient.observation_times[t_index]-patient.observation_times[t_index-1]
-                expm_A = expm(A * t)
-                Pt_kl = self.expm_Q_t[t]
-                Zeta_matrix = self.get_zeta(t,patient,Alpha[t_index-1],Beta[t_index],patient.O[t_index])
-                
-                temp_sum = 0.0
-                for k in range(num_state):
-                    for l in range(num_state):
-                        if Pt_kl[k,l] != 0:
-                            temp_sum = temp_sum + Zeta_matrix[k, l] * expm_A[k, l + num_state] / Pt_kl[k,l]
-                        
-                TauI[i] = TauI[i] + temp_sum
-
-                ni = temp_sum * (-self.Q[i, i])
-                Nij_mat[i, i] = Nij_mat[i, i] + ni
+            expm_A_all = expm(A * unique_times)[:, :num_state, num_state:]
+            #sum over all time intervals and all (k,l) at once
+            temp_sum = np.sum(F_stack * expm_A_all[time_index])
+            TauI[i] = TauI[i] + temp_sum
+            Nij_mat[i, i] = Nij_mat[i, i] + temp_sum * (-self.Q[i, i])
             A[i, i + num_state] = 0
             
-            
-        for i in range(num_state):
-            for j in range(num_state):
-                if self.Q_struct[i,j] == 1:
-                    A[i, j + num_state] = 1
-                    for t_index in range(1,T):
-                        t = patient.observation_times[t_index]-patient.observation_times[t_index-1]
-                        expm_A = expm(A * t)
-                        Pt_kl = self.expm_Q_t[t]    # change later
-                        Zeta_matrix = self.get_zeta(t,patient,Alpha[t_index-1],Beta[t_index],patient.O[t_index])
-                        
-                        temp_sum = 0.0
-                        for k in range(num_state):
-                            for l in range(num_state):
-                                if Pt_kl[k,l] != 0:
-                                    temp_sum = temp_sum + Zeta_matrix[k, l] * expm_A[k, l + num_state] / Pt_kl[k,l]
-
-                        nij = temp_sum * (self.Q[i, j])
-                        Nij_mat[i, j] = Nij_mat[i, j] + nij
-
-                A[i, j + num_state] = 0
+        #only the transitions allowed by Q_struct
+        for i, j in self.Q_idx:
+            A[i, j + num_state] = 1
+            expm_A_all = expm(A * unique_times)[:, :num_state, num_state:]
+            temp_sum = np.sum(F_stack * expm_A_all[time_index])
+            Nij_mat[i, j] = Nij_mat[i, j] + temp_sum * (self.Q[i, j])
+            A[i, j + num_state] = 0
         
         return TauI, Nij_mat
         
     def Eigen_Nij_all_times(self,patient,fast_eigen=True):
         '''
-        @param patient: a Patient object
+        @param patient: a Patient object, its emissions, Alpha and Beta have to be computed for the current parameters
+        @description: expects self.Psi_eigen to be set for the current Q, see EM_step
         '''
         T = patient.num_obs
         num_state = self.num_state
         Nij_mat = np.zeros((num_state,num_state))
-        patient.alpha_forward_recursion(self)
         Alpha = patient.Alpha
-        patient.beta_backward_recursion(self)
         Beta = patient.Beta
-        patient.get_all_emissions_gaussian(self)
-        if fast_eigen:
-            for i in range(1,T):
-                t = patient.observation_times[i]-patient.observation_times[i-1]
-                Zeta_matrix = self.get_zeta(t,patient,Alpha[i-1],Beta[i],patient.O[i])
-                Psi_eigen = self.calculate_Psi_eigen(t)
-                Nij_mat += self.Eigen_Nij_time_interval(Zeta_matrix, t, Psi_eigen)
-        else:
-            for l in range(1,T):
-                t = patient.observation_times[l]-patient.observation_times[l-1]
-                Zeta_matrix = self.get_zeta(t,patient,Alpha[l-1],Beta[l],patient.O[l])
-                F = Zeta_matrix/self.expm_Q_t[t]
-                for i in range(self.num_state):
-                    for j in range(self.num_state):
-                        Nij_mat[i,j] += np.sum(np.multiply(self.Nij_end_state[(t,i,j)],F))
+        for i in range(1,T):
+            t = patient.observation_times[i]-patient.observation_times[i-1]
+            Zeta_matrix = self.get_zeta(t,patient,Alpha[i-1],Beta[i],i)
+            Nij_mat += self.Eigen_Nij_time_interval(Zeta_matrix, t, self.Psi_eigen[t])
         return Nij_mat
 
     def Eigen_TauI_all_times(self,patient,fast_eigen=True):
+        '''
+        @param patient: a Patient object, its emissions, Alpha and Beta have to be computed for the current parameters
+        @description: expects self.Psi_eigen to be set for the current Q, see EM_step
+        '''
         T = patient.num_obs
         num_state = self.num_state
         TauI = np.zeros(num_state)
-        patient.alpha_forward_recursion(self)
         Alpha = patient.Alpha
-        patient.beta_backward_recursion(self)
         Beta = patient.Beta
-        if fast_eigen:
-            for i in range(1,T):
-                t = patient.observation_times[i]-patient.observation_times[i-1]
-                Zeta_matrix = self.get_zeta(t,patient,Alpha[i-1],Beta[i],patient.O[i])
-                Psi_eigen = self.calculate_Psi_eigen(t)
-                TauI += self.Eigen_TauI_time_interval(Zeta_matrix, t, Psi_eigen)
-#                 if (np.isnan(TauI).any()):
-#                     import pdb; pdb.set_trace()
-        else:
-            for l in range(1,T):
-                t = patient.observation_times[l]-patient.observation_times[l-1]
-                Zeta_matrix = self.get_zeta(t,patient,Alpha[l-1],Beta[l],patient.O[l])
-                F = Zeta_matrix/self.expm_Q_t[t]
-                for i in range(self.num_state):
-                    TauI[i]+=np.sum(np.multiply(self.TauI_end_state[(t,i)],F))
+        for i in range(1,T):
+            t = patient.observation_times[i]-patient.observation_times[i-1]
+            Zeta_matrix = self.get_zeta(t,patient,Alpha[i-1],Beta[i],i)
+            TauI += self.Eigen_TauI_time_interval(Zeta_matrix, t, self.Psi_eigen[t])
 #         if (np.isnan(TauI).any()):
 #             import pdb; pdb.set_trace()
         return TauI
     
-    def get_zeta(self,t,patient,alpha,beta,obs):
+    def get_zeta(self,t,patient,alpha,beta,obs_index):
         '''
         @summary: calculate zeta from the paper
         @param i,j: state from and to
@@ -424,10 +515,12 @@ class CT_HMM_LEARNER:
         @param alpha: alpha vector for time t
         @param beta: beta vector for time t+1
         @param globalParams: as everywhere
-        @param observations_t: all observations for time t, all types
+        @param obs_index: index of the observation at time t+1
         @return: the zeta for state i to j
         '''
-        b = patient.b_s(obs)
+        #zeta does not change if b is rescaled, so shift the log emissions to avoid underflow
+        log_b = patient.log_B[obs_index]
+        b = np.exp(log_b - np.max(log_b))
         likelihood = np.dot(alpha,np.dot(self.expm_Q_t[t],beta*b))
         return self.expm_Q_t[t]*np.outer(alpha, np.transpose(b*beta))/likelihood
 
@@ -445,89 +538,72 @@ class Patient:
     def get_all_emissions_gaussian(self,ct_hmm_learner):
         '''
         @param ct_hmm_learner: a CT_HMM_Learner object
-        @description: iterates over all observations and gets the likelihood for each state
-        @set self.emissions: a dictionary where keys are observation values and values are a list of likelihoods per state
+        @description: gets the likelihood for each state of all observations at once
+        @set self.log_B: a (T,n) array, row t holds the log likelihoods per state of observation t
+        @set self.B: exp(self.log_B)
         '''
-        gaussian_emissions = {}
-        for i in range(len(self.O)):
-            gaussian_emissions[self.O[i]] = self.emission_Gaussian(ct_hmm_learner,self.O[i])
-        self.emissions = gaussian_emissions
+        self.log_B = ct_hmm_learner.gaussian_log_emissions(self.O)
+        self.B = np.exp(self.log_B)
     
     def emission_Gaussian(self,ct_hmm_learner,obs):
         '''
         @param ct_hmm_learner: a CT_HMM_Learner object
         @param obs: an observation
         @description: for a single observation, get the likelihood under each state
-        @return: emissions, a list of likelihoods (one for each state)
-        '''
-        ls_mu_all = ct_hmm_learner.ls_mu
-        ls_sigma_all = ct_hmm_learner.ls_sigma
-        emissions = []
-        if len(ls_mu_all) == 1:
-            ls_mu_combo = ls_mu_all[0]
-            ls_sigma_combo = ls_sigma_all[0]
-            for ls_mu, ls_sigma in zip(ls_mu_combo, ls_sigma_combo):
-                emissions.append(norm.pdf(obs,ls_mu,ls_sigma))
-        else:
-            ls_mu_combo = list(itertools.product(*ls_mu_all))
-            ls_sigma_combo = list(itertools.product(*ls_sigma_all))
-            for ls_mu, ls_sigma in zip(ls_mu_combo, ls_sigma_combo):
-                emissions.append(multivariate_normal.pdf(obs,ls_mu,[sigma ** 2 for sigma in ls_sigma]))
-                
-        return emissions
+        @return: emissions, an array of likelihoods (one for each state)
+        '''
+        return ct_hmm_learner.gaussian_emissions([obs])[0]
     
-    def b_s(self,obs):
+    def b_s(self,obs_index):
         '''
-        @param obs: observation value
-        @return: list of likelihoods for observation, one for each state
+        @param obs_index: index of the observation
+        @return: array of likelihoods for observation, one for each state
         '''
-        return self.emissions[obs]
+        return self.B[obs_index]
         
+    def get_recursion_inputs(self,ct_hmm_learner):
+        '''
+        @param ct_hmm_learner: a CT_HMM_LEARNER object
+        @return: expm(Q*t) stacked for each interval between observations (T-1,n,n) and the log emissions self.log_B (T,n)
+        '''
+        num_state = ct_hmm_learner.num_state
+        expm_Q_t_stack = np.array([ct_hmm_learner.expm_Q_t[self.observation_times[i]-self.observation_times[i-1]] for i in range(1,self.num_obs)]).reshape(self.num_obs-1,num_state,num_state)
+        return expm_Q_t_stack, self.log_B
+
     def alpha_forward_recursion(self,ct_hmm_learner):
         '''
         @summary: perform the forward recursion, get alpha value for all time steps
         @param ct_hmm_learner: a CT_HMM_LEARNER object
+        @set self.Alpha: scaled forward probabilities
+        @set self.C: log scaling factors, they sum to the log-likelihood of the patient
         '''
-        O = self.O
-        T = self.num_obs
-        #Initialize Alpha for observations
-        Alpha = np.zeros((T,ct_hmm_learner.num_state))
-        C = np.zeros(T)
-        Alpha[0],C[0] = self.get_alpha_vector(0,O[0],ct_hmm_learner,0,pi0=ct_hmm_learner.pi0)
-        #add a column of 0's to the observation times
-        observation_times = np.zeros((len(self.observation_times),2))
-        observation_times[:,0] = self.observation_times
-        all_times = observation_times
-        #iterate over all times, keep track of observation index and event index
-        T = np.shape(all_times)[0]
-        for i in range(1,T):
-            #if i is 0 simply increment
-            t = self.observation_times[i]-self.observation_times[i-1]
-            Alpha[i,:],C[i] = self.get_alpha_vector(t,O[i],ct_hmm_learner,Alpha[i-1,:])
-            #increment observation
-        self.Alpha = Alpha
-        self.C = C
+        expm_Q_t_stack, log_b_stack = self.get_recursion_inputs(ct_hmm_learner)
+        self.Alpha, self.C = forward_recursion(np.asarray(ct_hmm_learner.pi0, dtype=float), expm_Q_t_stack, log_b_stack)
         
-    def get_alpha_vector(self,t,obs, ct_hmm_learner,alpha_prev,pi0=0):
+    def get_alpha_vector(self,t,obs_index, ct_hmm_learner,alpha_prev,pi0=0):
         '''
         @summary: alpha vector for a single time step
         @params: same as for state
+        @param obs_index: index of the observation, None if there is no observation at this step
         @return: alpha vector
         '''
         #initialize alpha vector, one element per state
         alpha = np.zeros(ct_hmm_learner.num_state)
-        if obs==None:
+        if obs_index is None:
             b=1
         else:
             #get the emissions
-            b = self.b_s(obs)
+            b = self.b_s(obs_index)
         if t!=0:
             #if this is not the first observation
             if t in ct_hmm_learner.expm_Q_t:
                 expm_matrix = ct_hmm_learner.expm_Q_t[t]
+                alpha = b*np.dot(np.transpose(expm_matrix),alpha_prev)
+            elif ct_hmm_learner.use_expm_multiply():
+                #Q is large and sparse, only the action of expm(Q*t)^T on alpha_prev is needed
+                alpha = b*expm_multiply(csc_matrix(np.transpose(ct_hmm_learner.Q))*t, alpha_prev)
             else:
-                expm_matrix = expm(Q*t)
-            alpha = b*np.dot(np.transpose(expm_matrix),alpha_prev)
+                alpha = b*np.dot(np.transpose(expm(ct_hmm_learner.Q*t)),alpha_prev)
         else:
             #if this is the first observation
             alpha = pi0*b
@@ -541,51 +617,13 @@ class Patient:
     def beta_backward_recursion(self,ct_hmm_learner):
         '''
         @param ct_hmm_learner: CT_HMM_LEARNER object
+        @description: uses the log scaling factors self.C from alpha_forward_recursion
         '''
-        #get scaling factors
-        C = self.C
-        #get number of observations
-        T = self.num_obs
-        #get observation values
-        O = self.O
-        #initialize Beta matrix to 1's
-        Beta = np.ones((T,ct_hmm_learner.num_state))
-        observation_times = np.zeros((len(self.observation_times),2))
-        observation_times[:,0] = self.observation_times
-        all_times = observation_times
-        T = len(all_times[:,0])
-        #iterate backwards
-        for i in range(T-2,-1,-1):
-            t = self.observation_times[i+1]-self.observation_times[i]
-            Beta[i,:] = self.get_beta_vector(C,t,i,O[i+1],ct_hmm_learner,Beta[i+1,:])
-            if (np.isnan(Beta).any()):
-                import pdb; pdb.set_trace()
-        
-        self.Beta = Beta
-    
-    def get_beta_vector(self,C,t,i,next_obs, ct_hmm_learner,beta_after):
-        '''
-        @summary: beta vector
-        @params C: scaling factors
-        @params t: time interval
-        @param i: indexes observation number
-        @param next_obs: next observations
-        @param ct_hmm_learner: 
-        '''
-        #get emissions for the observation
-        b = self.b_s(next_obs)
-        if t in ct_hmm_learner.expm_Q_t:
-            expm_matrix = ct_hmm_learner.expm_Q_t[t]
-        else:
-            expm_matrix = expm(Q*t)
-        components = np.log(beta_after)+np.log(expm_matrix)+np.log(b)
-        logSumExp = logsumexp(components,1)
-        beta = np.exp(logSumExp)
-        #scale beta
-        beta = beta/C[i+1]
-        if (np.isnan(beta).any()):
+        expm_Q_t_stack, log_b_stack = self.get_recursion_inputs(ct_hmm_learner)
+        Beta = backward_recursion(expm_Q_t_stack, log_b_stack, self.C)
+        if (np.isnan(Beta).any()):
             import pdb; pdb.set_trace()
-        return beta
+        self.Beta = Beta
     
     def predict(self, t,ct_hmm_learner,predict_observations=True):
         '''
@@ -593,10 +631,8 @@ class Patient:
         @params ct_hmm_learner: the CT_HMM_LEARNER object
         @params predict_observations: if True, predict the observation at time t based on mean, else return state probability vector
         '''
-        prev_time = 0
-        for idx, obs_times in enumerate(self.observation_times):
-            if obs_times < t:
-                prev_time = idx
+        #index of the last observation before t
+        prev_time = max(bisect.bisect_left(self.observation_times, t) - 1, 0)
             
         alpha_predict = self.get_alpha_vector(t-self.observation_times[-1],None, ct_hmm_learner,self.Alpha[-1])[0]
         mu = np.array(ct_hmm_learner.ls_mu)
@@ -609,42 +645,31 @@ class Patient:
     def viterbi_outer_decoding(self, ct_hmm_learner):
         '''
         @params ct_hmm_learner: the CT_HMM_LEARNER object
-        @return best_state_path: List of Lists. Outer list is for each state. Inner List is best previous state at a particular time, where the time is the index within inner list
+        @return final_best_state_path: most probable state at each observation time
+        @return time_diffs: time intervals between observations
         '''
         
         time_diffs = [t - s for s, t in zip(self.observation_times, self.observation_times[1:])]
-        log_Pt = []
-        for time_diff in time_diffs:
-            log_Pt.append(np.log(expm(ct_hmm_learner.Q * time_diff)))
+        # Q is constant through the decoding, so the log transition probabilities are computed once per unique time interval
+        unique_time_diffs, time_diff_index = np.unique(time_diffs, return_inverse=True)
+        log_Pt_unique = np.log(expm(ct_hmm_learner.Q * unique_time_diffs[:, None, None]))
+        log_Pt = log_Pt_unique[time_diff_index]
 
-        miu_vals = np.zeros(ct_hmm_learner.num_state)
-        best_state_path = [[] for i in range(ct_hmm_learner.num_state)]
-        log_gaussian_emissions_total = []
+        num_state = ct_hmm_learner.num_state
+        # best_state_path[idx, state_t] is the best previous state for state_t at observation idx+1
+        best_state_path = np.zeros((len(time_diffs), num_state), dtype=int)
+        log_gaussian_emissions_total = ct_hmm_learner.gaussian_log_emissions(self.O)
 
-        log_gaussian_emissions = np.log(self.emission_Gaussian(ct_hmm_learner, self.O[0]))
-        log_gaussian_emissions_total.append(log_gaussian_emissions)
-        for i, state in enumerate(best_state_path):
-            state_pi0 = ct_hmm_learner.pi0[i]
-            miu_vals[i] = np.log(state_pi0) + log_gaussian_emissions[i]
+        miu_vals = np.log(ct_hmm_learner.pi0) + log_gaussian_emissions_total[0]
 
         times = self.observation_times
         for idx in range(len(time_diffs)):
-
-            log_gaussian_emissions = np.log(self.emission_Gaussian(ct_hmm_learner, self.O[idx+1]))
-            log_gaussian_emissions_total.append(log_gaussian_emissions)
-
-            temp_miu_vals_current = np.zeros(ct_hmm_learner.num_state)
-            for state_t in range(ct_hmm_learner.num_state):
-                temp_miu_t_vals = []
-                for state_t_minus_1 in range(ct_hmm_learner.num_state):
-                    log_transition_prob = log_Pt[idx][state_t_minus_1, state_t]
-                    temp_miu_t_vals.append(log_gaussian_emissions[state_t] + log_transition_prob + miu_vals[state_t_minus_1])
-                # now we choose which previous state best connects to the current state
-                best_state_t_minus_1_for_state_t = np.argmax(temp_miu_t_vals)
-                # update miu vals for each state i.e. probability of the given final state's previous path for each final state, because of outer for loop
-                temp_miu_vals_current[state_t] = temp_miu_t_vals[best_state_t_minus_1_for_state_t]
-                best_state_path[state_t].append(best_state_t_minus_1_for_state_t)
-            miu_vals = temp_miu_vals_current
+            # scores[state_t_minus_1, state_t] for every pair of states at once
+            scores = (log_gaussian_emissions_total[idx+1][None,:] + log_Pt[idx]) + miu_vals[:,None]
+            # now we choose which previous state best connects to each current state
+            best_state_path[idx] = np.argmax(scores, axis=0)
+            # update miu vals for each state i.e. probability of the given final state's previous path for each final state
+            miu_vals = scores[best_state_path[idx], np.arange(num_state)]
 
         # best FINAL state
         previous_state = np.argmax(miu_vals)
@@ -653,7 +678,7 @@ class Patient:
         final_best_state_path.append(previous_state)
         # now lets iterate through all timepoints
         for i in range(1, len(times)):
-            previous_state = best_state_path[previous_state][-i]
+            previous_state = best_state_path[-i, previous_state]
             final_best_state_path.append(previous_state)
 
         # because we were appending instead of prepending
@@ -680,12 +705,71 @@ class Patient:
             best_seq_idx = SeqList[0][0][2] # first row, the 3rd component is the best sequence index
         except:
             import pdb;pdb.set_trace()
-        best_state_seq_SSA = SSAProb_patient.Seqs[start_s, end_s][0][best_seq_idx]["seq"]
-        best_prob_SSA = SSAProb_patient.Seqs[start_s, end_s][0][best_seq_idx]["p"][-1]
+        best_bucket = SSAProb_patient.Seqs[SeqList[0][0][0], SeqList[0][0][1]]
+        best_state_seq_SSA = best_bucket.seqs[best_seq_idx]
+        best_prob_SSA = best_bucket.P[best_seq_idx, -1]
 
         return best_state_seq_SSA, best_prob_SSA
 
 
+class Bucket:
+    def __init__(self, num_time):
+        '''
+        @summary: the state sequences found so far from one start state to one end state, stored column-wise
+        @param num_time: length of the time grid the probability curves are evaluated on
+        @description: the arrays below are views of the first k rows of buffers that grow by doubling,
+                      so appending a sequence does not copy the whole bucket
+        '''
+        self.buffers = {
+            "P": np.empty((0, num_time)), # (k,T) probability curve of each sequence
+            "ndom": np.empty(0, dtype=np.int32), # (k,) number of sequences dominating each sequence
+            "P32": np.empty((0, num_time-1), dtype=np.float32), # (k,T-1) P[:,1:] rounded to float32, for screening dominance
+            "pmin": np.empty(0), # (k,) min and max of P[:,1:], the part of the curves compared for dominance
+            "pmax": np.empty(0),
+        }
+        self.seqs = [] # (k,) the state sequences, as tuples
+        self.row = {} # seq -> its row in P
+        self.update_views()
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def update_views(self):
+        for name, buffer in self.buffers.items():
+            setattr(self, name, buffer[:len(self.seqs)])
+
+    def find(self, seq):
+        '''
+        @return: row of seq in the bucket, None if it is not there
+        '''
+        return self.row.get(seq)
+
+    def append(self, seq, p, ndom=0):
+        k = len(self.seqs)
+        if k == len(self.buffers["P"]):
+            for name, buffer in self.buffers.items():
+                grown = np.empty((max(2*k, 1),) + buffer.shape[1:], dtype=buffer.dtype)
+                grown[:k] = buffer[:k]
+                self.buffers[name] = grown
+        self.buffers["P"][k] = p
+        self.buffers["ndom"][k] = ndom
+        self.buffers["P32"][k] = p[1:]
+        self.buffers["pmin"][k] = p[1:].min()
+        self.buffers["pmax"][k] = p[1:].max()
+        self.row[seq] = k
+        self.seqs.append(seq)
+        self.update_views()
+
+    def delete(self, ToKill):
+        ToKeep = np.ones(len(self.seqs), dtype=bool)
+        ToKeep[ToKill] = False
+        # compact the kept rows to the front of the buffers
+        for name, buffer in self.buffers.items():
+            buffer[:ToKeep.sum()] = buffer[:len(ToKeep)][ToKeep]
+        self.seqs = [seq for seq, keep in zip(self.seqs, ToKeep) if keep]
+        self.row = {seq: i for i, seq in enumerate(self.seqs)}
+        self.update_views()
+
 class SSAProb:
     def __init__(self,L, T, Starts, Time, MaxDom, HasSpecificEndState, Ends, Q_mat):
         '''
@@ -711,8 +795,15 @@ class SSAProb:
         self.MaxDom = MaxDom
         self.HasSpecificEndState = HasSpecificEndState
         self.Ends = Ends
+        # Successors of each state: a direct transition path, and, when aiming for specific end states, a path to one of them
+        CanExtendTo = self.T > 0
+        if self.HasSpecificEndState:
+            CanExtendTo &= (self.Pt[:, self.Ends] > 0).any(axis=1)[None, :]
+        self.Succ = [np.flatnonzero(CanExtendTo[i]).tolist() for i in range(len(L))]
+        self.FailFastMaxBucket = 16 # buckets up to this size use the pairwise fail fast dominance test
+        self.MaxBatch = 256 # most sequences tested together when running with n_jobs > 1
 
-    def StateSequenceAnalyze(self):
+    def StateSequenceAnalyze(self, n_jobs=1):
         '''
         StateSequenceAnalyze finds all non-dominated state sequences for a given
         continuous-time Markov chain, a given start state or set of start states,
@@ -723,90 +814,96 @@ class SSAProb:
 
         @return TimeGrid = the numerical grid for evaluation of state sequence
                 probabilities and likelihoods
-        @return Seqs = an NxN cell array where N is the number of states of the chain,
-                in which .Seqs{i,j} is the set of non-dominated state sequences from
-                state i to state j. Each sequence is represented by a structure which
-                itself contains two fields: .seq is the state sequence, and .p is its
-                probability as a function of time.
+        @return Seqs = a dict keyed by (i,j) for the N states of the chain, in
+                which Seqs[i,j] is the Bucket of non-dominated state sequences from
+                state i to state j. Bucket.seqs holds the state sequences, and row k
+                of Bucket.P is the probability of seqs[k] as a function of time.
+
+        @params n_jobs = number of threads for the dominance tests, <= 0 uses one per cpu. With numba and
+                more than one thread, queued sequences going to different buckets are tested together, see NextBatch.
         '''
+        n_jobs = effective_n_jobs(n_jobs)
+        if HAS_NUMBA and n_jobs > 1:
+            OldThreads = get_num_threads()
+            set_num_threads(min(n_jobs, OldThreads))
+            try:
+                return self.AnalyzeQueue(Batched=True)
+            finally:
+                set_num_threads(OldThreads)
+        return self.AnalyzeQueue(Batched=False)
+
+    def AnalyzeQueue(self, Batched):
         # How many states in the system?
         NStates = len(self.L)
 
-        # Initialize Seqs "cell" array (legacy MATLAB cell type)
-        self.Seqs = np.empty((NStates, NStates), dtype=object)
+        # Initialize Seqs, one Bucket per (start, end) pair
+        self.Seqs = {}
         for i in range(NStates):
             for j in range(NStates):
-                 self.Seqs[i,j] = []
+                 self.Seqs[i,j] = Bucket(len(self.TimeGrid))
 
         # Initialize information for start states and enqueue their possible extensions
-        Queue = []
+        Queue = deque()
         for Start in self.Starts:
-            TempSeq = {}
-            TempSeq["seq"] = [Start]
-            TempSeq["p"] = np.exp(-self.L[Start] * self.TimeGrid) #probability of sequence
-            TempSeq["ndom"] = 0
-            self.Seqs[Start, Start].append(TempSeq)
+            self.Seqs[Start, Start].append((int(Start),), self.ComputeP((int(Start),))) #probability of sequence
 
             # add a single step extension 
-            for j in range(NStates):
-                if self.T[Start, j] > 0: # there is a direct transition path 
-                    # ==============================================
-                    if self.HasSpecificEndState == False: # Yu-ying code
-                        Queue.append([Start, j])
-                    else:
-                        has_path_to_end = False
-                        for g in range(len(self.Ends)):
-                            OneEnd = self.Ends[g]
-                            if (self.Pt[j, OneEnd] > 0):
-                                has_path_to_end = True
-                                break
-
-                        if has_path_to_end:
-                            Queue.append([Start, j])
-                    # ==============================================
-                # a direct path
-            # for j
+            for j in self.Succ[Start]:
+                Queue.append((int(Start), j))
 
         # Keep processing sequences, as long as the queue is not empty!
         while Queue:
-            # Get next sequence and process it unless it's parent is gone, so then it should be gone
-            Seq = Queue[0]
-            # print([x+1 for x in Seq])
-            
-            Queue = Queue[1:]
-            Parent = self.FindParent(self.Seqs, Seq)
-
-            if Parent is not None:
-                # Compute the sequence's probability curve and create a structure for it
-                TempSeq = {}
-                TempSeq["seq"] = Seq
-                TempSeq["p"] = self.ComputeP(Seq,Parent) #probability of sequence
-                TempSeq["ndom"] = 0
+            # Get next sequences and process them unless their parent is gone, so then they should be gone
+            if Batched:
+                Batch = self.NextBatch(Queue)
+            else:
+                # the consecutive extensions of the same parent
+                Batch = [Queue.popleft()]
+                while Queue and Queue[0][:-1] == Batch[0][:-1]:
+                    Batch.append(Queue.popleft())
 
+            # Compute the sequences' probability curves, together for the children of each parent
+            NewSeqs = []
+            NewPs = []
+            for PSeq, Siblings in itertools.groupby(Batch, key=lambda Seq: Seq[:-1]):
+                Siblings = list(Siblings)
+                if self.FindParent(self.Seqs, Siblings[0]) is not None:
+                    NewSeqs.extend(Siblings)
+                    NewPs.extend(self.ComputePBatch(Siblings)) #probability of sequence
 
-                self.Seqs, ItsAKeeper = self.UpdateSeqs(self.Seqs, TempSeq)
+            if Batched:
+                Keepers = self.UpdateSeqsBatch(NewSeqs, NewPs)
+            else:
+                Keepers = []
+                for Seq, p in zip(NewSeqs, NewPs):
+                    # keeping an earlier sibling may have dropped the parent, then this one goes too
+                    if self.FindParent(self.Seqs, Seq) is None:
+                        Keepers.append(False)
+                    else:
+                        Keepers.append(self.UpdateSeqs(Seq, p))
 
-                # If it wasn't dominated (or not too much), add the possible single-step extensions to the queue.
+            # If it wasn't dominated (or not too much), add the possible single-step extensions to the queue.
+            for Seq, ItsAKeeper in zip(NewSeqs, Keepers):
                 if ItsAKeeper:
-                    for i in range(NStates):
-                        # ==============================================
-                        if self.T[Seq[-1], i] > 0:  # Direct Transition Path
-                            # ==============================================
-                            if self.HasSpecificEndState == False: # Added by Yu-ying
-                                Queue.append(Seq + [i])
-                            else: # Added by Yu-ying
-                                has_path_to_end = False
-                                for g in range(len(self.Ends)): # foreach possible end state
-                                    OneEnd = self.Ends[g]
-                                    if (self.Pt[i, OneEnd] > 0):
-                                        has_path_to_end = True
-                                        break
-                                if has_path_to_end:
-                                    Queue.append(Seq + [i])
-                            # ==============================================
-                            # a Direct path
-                        # ==============================================
-                
+                    for i in self.Succ[Seq[-1]]:
+                        Queue.append(Seq + (i,))
+
+    def NextBatch(self, Queue):
+        '''
+        Pop the longest run of queued sequences that can be processed together: each one goes
+        to a different bucket, and none goes to the bucket holding a later one's parent, so the
+        result is the same as processing them one at a time
+        '''
+        Batch = [Queue.popleft()]
+        Touched = {(Batch[0][0], Batch[0][-1])}
+        while Queue and len(Batch) < self.MaxBatch:
+            Seq = Queue[0]
+            if (Seq[0], Seq[-1]) in Touched or (Seq[0], Seq[-2]) in Touched:
+                break
+            Touched.add((Seq[0], Seq[-1]))
+            Batch.append(Queue.popleft())
+        return Batch
+
     def ExtractMaxSeqs(self):
         '''
         ExtractMaxSeqs is inteded to extract sequences that are maximally
@@ -848,8 +945,7 @@ class SSAProb:
         # import pdb; pdb.set_trace()
         for Starts in StartStates:
             for Ends in EndStates:
-                for S in range(len(self.Seqs[Starts, Ends])):
-                    CurrProbs.append(self.Seqs[Starts, Ends][S]["p"][i] * StartWeights[Starts] * EndWeights[Ends])
+                CurrProbs.extend(self.Seqs[Starts, Ends].P[:, i] * StartWeights[Starts] * EndWeights[Ends])
         CutoffProb = None
         if len(CurrProbs) > 0:
             CurrProbs = np.sort(CurrProbs)[::-1]
@@ -860,7 +956,7 @@ class SSAProb:
             for Starts in StartStates:
                 for Ends in EndStates:
                     for S in range(len(self.Seqs[Starts, Ends])):
-                        if self.Seqs[Starts, Ends][S]["p"][i] * StartWeights[Starts] * EndWeights[Ends] >= CutoffProb:
+                        if self.Seqs[Starts, Ends].P[S, i] * StartWeights[Starts] * EndWeights[Ends] >= CutoffProb:
                             TempSeqs.append([Starts, Ends, S])
 
         # MaxSeqsByTime
@@ -887,64 +983,139 @@ class SSAProb:
         return MaxSeqsByTime, SeqList
 
     def FindParent(self, Seqs, Seq):
-        Parent = None
+        '''
+        @return Parent_p = probability curve of Seq[:-1], None if it is not (or no longer) in Seqs
+        '''
+        Parent_p = None
         if len(Seq) >= 2:
             PSeq = Seq[0:-1]
             PStart = PSeq[0]
             PEnd = PSeq[-1]
-            for i in range(len(Seqs[PStart, PEnd])):
-                TempSeq = Seqs[PStart, PEnd][i]
-                if len(TempSeq["seq"]) == len(PSeq):
-                    if (TempSeq["seq"] == PSeq):
-                        Parent = TempSeq
-                        return Parent
-        return Parent
-
-    def ComputeP(self, Seq, Parent):
-        '''
-        Compute the time-dependent probability of a state sequence
-        '''
-        NextToLastState = Parent["seq"][-1]
-        pfunc = lambda t: interp1d(self.TimeGrid, Parent["p"])(t)
-        A = -self.L[Seq[-1]]
-        B = self.L[Parent["seq"][-1]] * self.T[NextToLastState, Seq[-1]]
-        RHS = lambda t,y: A*y + B*pfunc(t)
-        
-        P = solve_ivp(RHS, y0=[0], t_span=[np.min(self.TimeGrid), np.max(self.TimeGrid)], t_eval=list(self.TimeGrid), rtol=1e-10, atol=1e-10)
-        return P.y[0]
+            PBucket = Seqs[PStart, PEnd]
+            i = PBucket.find(PSeq)
+            if i is not None:
+                Parent_p = PBucket.P[i]
+        return Parent_p
+
+    def ComputeP(self, Seq):
+        '''
+        Compute the time-dependent probability of a state sequence, see ComputePBatch
+        '''
+        return self.ComputePBatch([Seq])[0]
+
+    def ComputePBatch(self, Seqs):
+        '''
+        Compute the time-dependent probabilities of state sequences of the same length
+
+        The probability of following Seq = s_0..s_k up to time t is e_k' * expm(G*t) * e_0, with G
+        the generator of the path: G[m,m] = -L[s_m] and G[m+1,m] = L[s_m]*T[s_m, s_m+1]. Scaling the
+        subdiagonal to ones leaves the product of the transition rates as a factor, and what remains is
+        symmetric in the diagonal, so it is evaluated with the diagonal sorted. Sequences with the same
+        curve, e.g. visiting the same states in another order, then get exactly the same numbers and
+        tie in the dominance tests, instead of one dominating the other through rounding.
+
+        @params Seqs = state sequences, all of the same length
+        @return P = (len(Seqs), len(TimeGrid)) array, the probability curve of each sequence
+        '''
+        Seqs = np.array(Seqs)
+        NSeqs, k = Seqs.shape[0], Seqs.shape[1] - 1
+        Rates = self.L[Seqs[:, :-1]] * self.T[Seqs[:, :-1], Seqs[:, 1:]]
+        G = np.eye(k+1, k=-1) - np.sort(self.L[Seqs], axis=1)[:, :, None]*np.eye(k+1)
+
+        # TimeGrid is evenly spaced but for its last step: X[:, :, i] = expm(G*h)^i * e_0, filled by
+        # doubling, each power of expm(G*h) extends the known columns to twice as many
+        NSteps = len(self.TimeGrid) - 1
+        X = np.zeros((NSeqs, k+1, len(self.TimeGrid)))
+        X[:, 0, 0] = 1
+        Power = expm(G*(self.TimeGrid[1] - self.TimeGrid[0]))
+        Done = 1
+        while Done < NSteps:
+            n = min(Done, NSteps - Done)
+            X[:, :, Done:Done+n] = np.matmul(Power, X[:, :, :n])
+            Done += n
+            Power = np.matmul(Power, Power)
+        X[:, :, -1] = np.matmul(expm(G*(self.TimeGrid[-1] - self.TimeGrid[-2])), X[:, :, -2:-1])[:, :, 0]
+        return np.prod(np.sort(Rates, axis=1), axis=1)[:, None] * X[:, -1, :]
 
-    def UpdateSeqs(self, InSeqs, NewSeq):
+    def DominanceCandidates(self, SeqBucket, NewP):
+        # A curve lying above another everywhere also has the larger min and max, so only
+        # sequences whose (min, max) are both above or both below NewSeq's need the full test
+        NewMin = NewP.min()
+        NewMax = NewP.max()
+        return np.flatnonzero(((SeqBucket.pmin > NewMin) & (SeqBucket.pmax > NewMax)) |
+                              ((SeqBucket.pmin < NewMin) & (SeqBucket.pmax < NewMax)))
+
+    def UpdateSeqs(self, NewSeq, NewP):
+        '''
+        Add NewSeq to self.Seqs in place, with the dominance bookkeeping of its bucket
+
+        @params NewP = probability curve of NewSeq
+        @return ItsAKeeper = whether NewSeq was kept
+        '''
         # Start and End States
-        Start = NewSeq["seq"][0]
-        End = NewSeq["seq"][-1]
+        Start = NewSeq[0]
+        End = NewSeq[-1]
 
         # Establish Dominance Relationships
-        DomOthers = [] # Whether NewSeq dominates already found sequences
-        for i in range(len(InSeqs[Start, End])):
-            TempDiff = InSeqs[Start, End][i]["p"][1:] - NewSeq["p"][1:]
+        SeqBucket = self.Seqs[Start, End]
+        Cand = self.DominanceCandidates(SeqBucket, NewP[1:])
+        if HAS_NUMBA and len(Cand) <= self.FailFastMaxBucket:
+            # few candidates, compare pairwise and stop each comparison at the first undecided coordinate
+            Dom = np.array([dominance_pair(Other, NewP[1:]) for Other in SeqBucket.P[Cand, 1:]], dtype=int)
             # If NewSeq is dominated...
-            if (TempDiff > 0).all():
-                NewSeq["ndom"] += 1
+            NewNDom = int((Dom == 1).sum())
+            DomOthers = Cand[Dom == -1] # Whether NewSeq dominates already found sequences
+        else:
+            # many candidates, one broadcast over all of them in float32. Rounding is monotone, so a
+            # curve above NewSeq everywhere is still >= after rounding, and only those need the exact test
+            P32 = SeqBucket.P32[Cand]
+            NewP32 = NewP[1:].astype(np.float32)
+            MaybeAbove = Cand[(P32 >= NewP32).all(axis=1)]
+            MaybeBelow = Cand[(P32 <= NewP32).all(axis=1)]
+            NewNDom = int((SeqBucket.P[MaybeAbove, 1:] > NewP[1:]).all(axis=1).sum())
+            DomOthers = MaybeBelow[(SeqBucket.P[MaybeBelow, 1:] < NewP[1:]).all(axis=1)]
 
-            if (TempDiff < 0).all():
-                DomOthers.append(i)
+        return self.InsertSeq(SeqBucket, NewSeq, NewP, NewNDom, DomOthers)
 
-        # If NewSeq dominated, or dominated by too many other sequences, we discard it, and we're done.
-        if NewSeq["ndom"] > self.MaxDom:
-            ItsAKeeper = False
-            OutSeqs = InSeqs
+    def UpdateSeqsBatch(self, NewSeqs, NewPs):
+        '''
+        UpdateSeqs for sequences going to different buckets, with all their pairwise
+        dominance tests run in parallel
+
+        @return Keepers = whether each of NewSeqs was kept
+        '''
+        SeqBuckets = [self.Seqs[NewSeq[0], NewSeq[-1]] for NewSeq in NewSeqs]
+        Cands = [self.DominanceCandidates(SeqBucket, NewP[1:]) for SeqBucket, NewP in zip(SeqBuckets, NewPs)]
+        Counts = np.array([len(Cand) for Cand in Cands], dtype=int)
+        Offsets = np.concatenate([[0], np.cumsum(Counts)])
+        if Offsets[-1] > 0:
+            Stack = np.concatenate([SeqBucket.P[Cand, 1:] for SeqBucket, Cand in zip(SeqBuckets, Cands)])
+            Dom = dominance_rows(Stack, np.array(NewPs)[:, 1:], np.repeat(np.arange(len(NewSeqs)), Counts))
         else:
-            ItsAKeeper = True
-            OutSeqs = InSeqs
+            Dom = np.zeros(0, dtype=int)
+
+        Keepers = []
+        for b in range(len(NewSeqs)):
+            BDom = Dom[Offsets[b]:Offsets[b+1]]
+            Keepers.append(self.InsertSeq(SeqBuckets[b], NewSeqs[b], NewPs[b], int((BDom == 1).sum()), Cands[b][BDom == -1]))
+        return Keepers
 
-            ToKill = []
-            for Other in DomOthers:
-                OutSeqs[Start, End][Other]["ndom"] += 1
-                if OutSeqs[Start, End][Other]["ndom"] > self.MaxDom:
-                    ToKill.append(Other)
-            OutSeqs[Start, End] = np.delete(OutSeqs[Start, End], ToKill).tolist()
+    def InsertSeq(self, SeqBucket, NewSeq, NewP, NewNDom, DomOthers):
+        '''
+        Add NewSeq to its bucket unless it is dominated too much, and drop the sequences it dominates too much
+
+        @params NewNDom = number of sequences of SeqBucket dominating NewSeq
+        @params DomOthers = rows of SeqBucket dominated by NewSeq
+        @return ItsAKeeper = whether NewSeq was added
+        '''
+        # If NewSeq dominated, or dominated by too many other sequences, we discard it, and we're done.
+        if NewNDom > self.MaxDom:
+            return False
 
-            OutSeqs[Start, End].append(NewSeq)
-            # import pdb; pdb.set_trace()
+        SeqBucket.ndom[DomOthers] += 1
+        ToKill = DomOthers[SeqBucket.ndom[DomOthers] > self.MaxDom]
+        if len(ToKill):
+            SeqBucket.delete(ToKill)
 
-        return OutSeqs, ItsAKeeper
+        SeqBucket.append(NewSeq, NewP, NewNDom)
+        return True
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy.linalg import expm
+from ct_hmm import SSAProb
+
+# sequences kept by the original solve_ivp implementation of ComputeP
+BASELINE_4_STATES_MAXDOM_0 = {(0,), (0, 1), (0, 1, 0), (0, 1, 0, 1), (0, 1, 0, 1, 2), (0, 1, 2), (0, 1, 2, 0), (0, 1, 2, 0, 1),
+    (0, 1, 2, 1), (0, 1, 2, 1, 2), (0, 1, 2, 3), (0, 1, 3), (0, 2), (0, 3), (1,), (1, 0), (1, 0, 1), (1, 0, 1, 0), (1, 0, 1, 2),
+    (1, 0, 1, 2, 0), (1, 2), (1, 2, 0), (1, 2, 0, 1), (1, 2, 0, 1, 0), (1, 2, 0, 1, 2), (1, 2, 1), (1, 2, 1, 0), (1, 2, 1, 2),
+    (1, 2, 3), (1, 3), (1, 3, 2)}
+BASELINE_5_STATES_MAXDOM_0 = {(0,), (0, 1), (0, 1, 0), (0, 1, 3), (0, 1, 4), (0, 2), (0, 2, 0), (0, 2, 0, 1), (0, 2, 0, 2),
+    (0, 2, 0, 2, 1), (0, 2, 0, 2, 3), (0, 2, 1), (0, 2, 1, 3), (0, 2, 1, 4), (0, 2, 3), (0, 2, 4), (0, 3), (0, 4)}
+BASELINE_5_STATES_MAXDOM_2 = {(0,), (0, 1), (0, 1, 0), (0, 1, 0, 1), (0, 1, 0, 1, 3), (0, 1, 0, 2), (0, 1, 0, 2, 0),
+    (0, 1, 0, 2, 1), (0, 1, 2), (0, 1, 3), (0, 1, 3, 0), (0, 1, 3, 1), (0, 1, 3, 2), (0, 1, 4), (0, 1, 4, 0), (0, 2), (0, 2, 0),
+    (0, 2, 0, 1), (0, 2, 0, 1, 0), (0, 2, 0, 1, 3), (0, 2, 0, 1, 4), (0, 2, 0, 2), (0, 2, 0, 2, 0), (0, 2, 0, 2, 1),
+    (0, 2, 0, 2, 1, 4), (0, 2, 0, 2, 3), (0, 2, 0, 2, 4), (0, 2, 0, 4), (0, 2, 1), (0, 2, 1, 0), (0, 2, 1, 0, 1),
+    (0, 2, 1, 0, 2), (0, 2, 1, 3), (0, 2, 1, 4), (0, 2, 3), (0, 2, 3, 4), (0, 2, 4), (0, 3), (0, 3, 1), (0, 4), (0, 4, 1),
+    (0, 4, 2), (0, 4, 3)}
+
+def make_ssa(num_state, seed, Starts, MaxDom):
+    rng = np.random.default_rng(seed)
+    Q = rng.uniform(0.1, 3, (num_state, num_state))
+    np.fill_diagonal(Q, 0)
+    np.fill_diagonal(Q, -np.sum(Q, 1))
+    L = -np.diag(Q)
+    return SSAProb(L=L, T=Q/L[:, None], Starts=Starts, Time=2, MaxDom=MaxDom,
+                   HasSpecificEndState=False, Ends=list(range(num_state)), Q_mat=Q)
+
+def kept_seqs(ssa):
+    ssa.StateSequenceAnalyze()
+    return {seq for bucket in ssa.Seqs.values() for seq in bucket.seqs}
+
+def test_computep_matches_path_generator():
+    ssa = make_ssa(4, 12, [0, 1], 0)
+    Seq = (1, 2, 0, 1, 0)
+    G = np.diag(-ssa.L[list(Seq)])
+    for m in range(len(Seq)-1):
+        G[m+1, m] = ssa.L[Seq[m]]*ssa.T[Seq[m], Seq[m+1]]
+    P = ssa.ComputeP(Seq)
+    for i in [1, 10, 1000, len(ssa.TimeGrid)-1]:
+        assert P[i] == pytest.approx(expm(G*ssa.TimeGrid[i])[-1, 0], rel=1e-10)
+
+def test_equal_curves_tie():
+    # same states visited in another order, the curves are the same function of time
+    ssa = make_ssa(4, 12, [0, 1], 0)
+    assert np.array_equal(ssa.ComputeP((1, 2, 0, 1, 0)), ssa.ComputeP((1, 0, 1, 2, 0)))
+
+@pytest.mark.parametrize("num_state, seed, Starts, MaxDom, expected", [
+    (4, 12, [0, 1], 0, BASELINE_4_STATES_MAXDOM_0),
+    (5, 11, [0], 0, BASELINE_5_STATES_MAXDOM_0),
+    (5, 11, [0], 2, BASELINE_5_STATES_MAXDOM_2),
+])
+def test_state_sequence_analyze_matches_baseline(num_state, seed, Starts, MaxDom, expected):
+    assert kept_seqs(make_ssa(num_state, seed, Starts, MaxDom)) == expected
+
+def test_ties_kept_with_maxdom():
+    Seqs = kept_seqs(make_ssa(4, 12, [0, 1], 2))
+    assert (1, 2, 0, 1, 0) in Seqs and (1, 0, 1, 2, 0) in Seqs